@@ -5,11 +5,18 @@ This module is an extension for ulauncher that searches for directories using
 the 'zoxide' command-line tool and displays the results sorted by zoxide's ranking.
 """
 
+import asyncio
+import collections
+import json
 import logging
-import re
 import time
 import os
+import queue
+import shutil
+import signal
 import subprocess
+import threading
+from concurrent.futures import CancelledError, Future
 from pathlib import Path
 from ulauncher.api.client.Extension import Extension
 from ulauncher.api.client.EventListener import EventListener
@@ -28,15 +35,126 @@ from ulauncher.api.shared.action.RenderResultListAction import RenderResultListA
 from ulauncher.api.shared.action.HideWindowAction import HideWindowAction
 from ulauncher.api.shared.action.DoNothingAction import DoNothingAction
 from ulauncher.api.shared.action.RunScriptAction import RunScriptAction
-import gi
-
-gi.require_version("Gtk", "3.0")
-from gi.repository import Gio, Gtk
 
 LOG_FORMAT = '%(asctime)s - %(levelname)s - %(module)s.%(funcName)s: %(message)s'
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+# basicConfig is already a no-op when the root logger has handlers; the guard
+# only makes that behaviour explicit.
+if not logging.getLogger().handlers:
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
 logger = logging.getLogger(__name__)
 
+# Bounds for the per-query result cache in ZoxideSearchExtension.search.
+QUERY_CACHE_SIZE = 64
+QUERY_CACHE_TTL = 2.0
+
+# Queries with fewer non-space characters than this are not sent to zoxide.
+MIN_QUERY_CHARS = 2
+
+# Long-lived helper shell that runs 'zoxide query' for each line read from
+# stdin. Each line is the result limit followed by the query words; output is
+# cut off by 'head' so zoxide stops early instead of listing its whole
+# database. zoxide's own exit status is passed out of the pipeline on fd 3,
+# while head writes the paths to the real stdout saved on fd 4. Output for a
+# query is terminated by a NUL-prefixed line carrying that status; paths
+# cannot contain NUL so the marker is unambiguous.
+QUERY_HELPER_SCRIPT = (
+    'set -f; z="$1"; exec 4>&1; '
+    'while read -r limit line; do '
+    'status=$({ { "$z" query $line --list </dev/null; echo $? >&3; } '
+    '| head -n "$limit" >&4; } 3>&1); '
+    'printf "\\0%s\\n" "$status"; '
+    'done')
+
+FALLBACK_FOLDER_ICON = "images/folder.png"
+ICON_CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "ulauncher-zoxide", "folder_icon.json")
+
+# Actions are stateless, so one instance of each is shared by all results.
+DO_NOTHING_ACTION = DoNothingAction()
+HIDE_WINDOW_ACTION = HideWindowAction()
+
+
+def _load_gtk():
+    """Import the GIO and GTK bindings on first use.
+
+    The bindings are slow to initialise and only needed to resolve the folder
+    icon, so they are kept out of module import.
+    """
+    import gi
+    gi.require_version("Gtk", "3.0")
+    from gi.repository import Gio, Gtk
+    return Gio, Gtk
+
+
+def _read_all(fd):
+    """Read from a file descriptor until EOF."""
+    chunks = []
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return b"".join(chunks)
+        chunks.append(chunk)
+
+
+def _spawn_capture(cmd):
+    """Run cmd with os.posix_spawn and capture its output.
+
+    Spawning avoids forking the (large) extension process. Returns a
+    subprocess.CompletedProcess with bytes stdout and stderr.
+    """
+    if not hasattr(os, "posix_spawn"):
+        return subprocess.run(cmd, capture_output=True, check=False)
+
+    # Pipe fds are created non-inheritable, so only the dup'ed ends reach
+    # the child.
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe()
+    try:
+        pid = os.posix_spawn(cmd[0], cmd, os.environ, file_actions=[
+            (os.POSIX_SPAWN_DUP2, out_w, 1),
+            (os.POSIX_SPAWN_DUP2, err_w, 2),
+        ])
+    except BaseException:
+        for fd in (out_r, out_w, err_r, err_w):
+            os.close(fd)
+        raise
+    os.close(out_w)
+    os.close(err_w)
+    try:
+        # zoxide writes at most a short message to stderr, so reading the
+        # streams one after the other cannot fill the stderr pipe.
+        stdout = _read_all(out_r)
+        stderr = _read_all(err_r)
+    finally:
+        os.close(out_r)
+        os.close(err_r)
+        _, status = os.waitpid(pid, 0)
+
+    if os.WIFEXITED(status):
+        returncode = os.WEXITSTATUS(status)
+    else:
+        returncode = -os.WTERMSIG(status)
+    return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+
+def is_searchable(query):
+    """Return whether a query has enough non-space characters to search."""
+    return bool(query) and sum(map(len, query.split())) >= MIN_QUERY_CHARS
+
+
+def compile_command_template(template):
+    """Return a callable that substitutes a quoted path into a command template.
+
+    Templates with a single bare '{}' or '{0}' field are handled with plain
+    string concatenation; anything else falls back to str.format.
+    """
+    if template.count("{") == 1 and template.count("}") == 1:
+        for field in ("{}", "{0}"):
+            prefix, sep, suffix = template.partition(field)
+            if sep:
+                return lambda path: prefix + path + suffix
+    return template.format
 
 
 class ZoxideSearchExtension(Extension):
@@ -46,39 +164,227 @@ class ZoxideSearchExtension(Extension):
         """Initialize the base class and subscribe to events."""
         # logger.info("Initializing ZoxideSearchExtension")
         super(ZoxideSearchExtension, self).__init__()
-        self.subscribe(KeywordQueryEvent, KeywordQueryEventListener())
+        self._keyword_listener = KeywordQueryEventListener()
+        self.subscribe(KeywordQueryEvent, self._keyword_listener)
         self.subscribe(PreferencesEvent, PreferencesLoadListener())
         self.subscribe(PreferencesUpdateEvent, PreferencesChangeListener())
         self.subscribe(ItemEnterEvent, ItemEnterEventListener())
         self.max_results = 10
         self.command_on_select = "xdg-open {}"
+        self._format_cmd = compile_command_template(self.command_on_select)
+        # Resolve zoxide once so each query does not repeat the PATH search.
+        self.zoxide_bin = shutil.which("zoxide")
+        self._query_cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._helper = None
+        self._helper_lock = threading.Lock()
+        # Cleared if the helper cannot be started at all; a helper that dies
+        # later is restarted on the next query.
+        self._helper_enabled = self.zoxide_bin is not None
+        if self._helper_enabled:
+            self._start_query_helper()
+        # Queries are run by a single worker so that, when typing fast, only
+        # the newest pending query spawns zoxide.
+        self._pending = queue.Queue()
+        threading.Thread(target=self._search_worker, daemon=True).start()
+        # Resolve the folder icon and page in zoxide's database off the main
+        # thread so the first keystroke is not held up by either.
+        threading.Thread(target=self._warmup, daemon=True).start()
+
+    def _warmup(self):
+        """Run the startup warm-up tasks concurrently."""
+        try:
+            asyncio.run(self._warmup_tasks())
+        except Exception as e:
+            logger.warning("Extension warm-up failed: %s", e, exc_info=True)
+
+    async def _warmup_tasks(self):
+        """Preload the folder icon and warm up zoxide at the same time."""
+        await asyncio.gather(self._preload_icon(), self._zoxide_warm())
+
+    async def _preload_icon(self):
+        """Resolve the folder icon in an executor thread."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self._keyword_listener.load_folder_icon)
+
+    async def _zoxide_warm(self):
+        """Run an unfiltered query so zoxide's database is in the page cache."""
+        if self.zoxide_bin is None:
+            return
+        process = await asyncio.create_subprocess_exec(
+            self.zoxide_bin, "query", "--list",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.DEVNULL)
+        await process.wait()
+
+    def submit_search(self, query):
+        """Queue a search and return a Future for its results.
+
+        Any searches still waiting in the queue are superseded by this one and
+        their futures are cancelled.
+        """
+        while True:
+            try:
+                _, stale_future = self._pending.get_nowait()
+            except queue.Empty:
+                break
+            stale_future.cancel()
+
+        future = Future()
+        self._pending.put((query, future))
+        return future
+
+    def _start_query_helper(self):
+        """Start the helper shell used to run queries without forking ulauncher."""
+        try:
+            self._helper = subprocess.Popen(
+                ["sh", "-c", QUERY_HELPER_SCRIPT, "sh", self.zoxide_bin],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        except OSError as e:
+            logger.warning(
+                "Could not start zoxide query helper, querying directly: %s", e)
+            self._helper = None
+            self._helper_enabled = False
+
+    def _stop_query_helper(self):
+        """Kill and reap the helper shell and close its pipes."""
+        helper, self._helper = self._helper, None
+        helper.kill()
+        helper.wait()
+        for stream in (helper.stdin, helper.stdout):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def _query_via_helper(self, query_words):
+        """Run a query through the helper shell.
+
+        Returns the raw output lines as bytes, or None if the helper is
+        unavailable and the caller should fall back to running zoxide directly.
+        A helper that failed on an earlier query is restarted first.
+        """
+        with self._helper_lock:
+            if self._helper is None:
+                if not self._helper_enabled:
+                    return None
+                self._start_query_helper()
+                if self._helper is None:
+                    return None
+            try:
+                self._helper.stdin.write(
+                    (" ".join([str(self.max_results)] + query_words) +
+                     "\n").encode("utf-8"))
+                self._helper.stdin.flush()
+                lines = []
+                while True:
+                    line = self._helper.stdout.readline()
+                    if not line:
+                        raise BrokenPipeError("zoxide query helper exited")
+                    if line.startswith(b"\0"):
+                        returncode = int(line[1:])
+                        break
+                    lines.append(line.rstrip(b"\n"))
+            except (OSError, ValueError) as e:
+                logger.warning(
+                    "zoxide query helper failed, querying directly: %s", e)
+                self._stop_query_helper()
+                return None
+
+        # zoxide being stopped by head closing the pipe is not a failure.
+        if returncode not in (0, 128 + signal.SIGPIPE):
+            # zoxide's stderr goes to the extension's stderr, i.e. the
+            # ulauncher log.
+            logger.error("zoxide query failed with code %d", returncode)
+            return []
+        return lines
+
+    def _first_paths(self, lines):
+        """Return the first max_results non-empty lines without scanning the rest.
+
+        Lines are zoxide's raw output; only the kept ones are decoded.
+        """
+        paths = []
+        if self.max_results <= 0:
+            return paths
+        for line in lines:
+            if line:
+                paths.append(line.decode("utf-8", "replace"))
+                if len(paths) >= self.max_results:
+                    break
+        return paths
+
+    def clear_query_cache(self):
+        """Forget cached query results, e.g. after the rankings changed."""
+        with self._cache_lock:
+            self._query_cache.clear()
+
+    def _search_worker(self):
+        """Run queued searches one at a time, skipping cancelled ones."""
+        while True:
+            query, future = self._pending.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.search(query))
+            except Exception as e:
+                future.set_exception(e)
 
     def search(self, query):
         """Search for entries matching a query using 'zoxide query'.
 
         Splits the query into words and passes them as separate arguments.
-        Returns a list of path strings sorted by zoxide's ranking.
+        Returns a list of path strings sorted by zoxide's ranking. Results are
+        cached briefly so retyping or backspacing over a prefix does not spawn
+        zoxide again. Queries that are too short to be useful return no
+        results without running zoxide.
         """
+        if not is_searchable(query):
+            return []
+        # Normalise whitespace so "a  b" and "a b" share a cache entry.
+        query = " ".join(query.split())
+        key = (query, self.max_results)
+        with self._cache_lock:
+            cached = self._query_cache.get(key)
+            if cached is not None and time.monotonic() - cached[0] < QUERY_CACHE_TTL:
+                self._query_cache.move_to_end(key)
+                return cached[1]
+
+        results = self._run_query(query)
+
+        if results and isinstance(results[0], dict):
+            return results
+        with self._cache_lock:
+            self._query_cache[key] = (time.monotonic(), results)
+            self._query_cache.move_to_end(key)
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+        return results
+
+    def _run_query(self, query):
+        """Run 'zoxide query' for the given query and return the paths."""
         results = []
         query_words = query.split()
 
-        cmd = ["zoxide", "query"]
+        if self.zoxide_bin is None:
+            logger.error(
+                "'zoxide' command not found. Please ensure zoxide is installed and in your PATH."
+            )
+            return [{
+                "error": "zoxide not found"
+            }]
+
+        lines = self._query_via_helper(query_words)
+        if lines is not None:
+            return self._first_paths(lines)
+
+        cmd = [self.zoxide_bin, "query"]
         cmd.extend(query_words)
         cmd.append("--list")
 
-        env_vars_to_log = ['HOME', 'USER', 'PATH', 'XDG_DATA_HOME', 'SHELL']
-        current_env = os.environ.copy()
-
         try:
-            process = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=
-                False,
-                encoding='utf-8',
-                env=current_env
-            )
+            process = _spawn_capture(cmd)
 
 #            if process.stderr:
 #                logger.debug("zoxide query stderr output: %s",
@@ -87,13 +393,14 @@ class ZoxideSearchExtension(Extension):
             if process.returncode != 0:
                 if process.stderr:
                     logger.error("zoxide query failed with code %d: %s",
-                                 process.returncode, process.stderr.strip())
+                                 process.returncode,
+                                 process.stderr.decode("utf-8", "replace").strip())
                 return []
 
 
-            paths = [line for line in process.stdout.splitlines() if line]
-
-            results = paths[:self.max_results]
+            # Bound the split so output past max_results is never scanned.
+            lines = process.stdout.split(b"\n", max(self.max_results, 0))
+            results = self._first_paths(lines[:self.max_results])
 
         except FileNotFoundError:
             logger.error(
@@ -128,6 +435,8 @@ class PreferencesLoadListener(EventListener):
             extension.max_results = 10
         extension.command_on_select = extension.preferences.get(
             "command_on_select", "xdg-open {}")
+        extension._format_cmd = compile_command_template(
+            extension.command_on_select)
         #logger.info(
         #    "Preferences loaded: max_results=%d, command_on_select='%s'",
         #    extension.max_results, extension.command_on_select)
@@ -150,6 +459,8 @@ class PreferencesChangeListener(EventListener):
                     event.new_value, extension.max_results)
         elif event.id == "command_on_select":
             extension.command_on_select = event.new_value
+            extension._format_cmd = compile_command_template(
+                extension.command_on_select)
             #logger.info("Preference 'command_on_select' updated to '%s'",
             #            extension.command_on_select)
 
@@ -160,25 +471,43 @@ class KeywordQueryEventListener(EventListener):
     def __init__(self):
         """Initialize the base class and members."""
         super(KeywordQueryEventListener, self).__init__()
-        self.folder_icon = self.get_folder_icon()
+        self._home = str(Path.home())
+        self._home_prefix = self._home.rstrip("/") + "/"
+        # The themed icon is resolved later by load_folder_icon; until then
+        # results use the bundled one.
+        self._set_folder_icon(FALLBACK_FOLDER_ICON)
+
+    def load_folder_icon(self):
+        """Resolve the themed folder icon and use it for later results."""
+        self._set_folder_icon(self._cached_icon_path())
+
+    def _set_folder_icon(self, folder_icon):
+        """Use the given icon path for result items."""
+        # Resolve the bundled fallback against the extension directory so the
+        # same absolute path string is handed to every result item.
+        self._icon_abs = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), folder_icon)
 
     def on_event(self, event, extension):
         """Run search if query was entered and act on results."""
         query = event.get_argument()
-        if not query:
+        if not is_searchable(query):
             return RenderResultListAction([
                 ExtensionResultItem(
                     icon="images/icon.png",
                     name="Type directory search terms...",
                     description=
                     "Uses zoxide to find frequently used directories",
-                    on_enter=DoNothingAction(),
+                    on_enter=DO_NOTHING_ACTION,
                 )
             ])
 
         # logger.info("Searching zoxide for query: '%s'", query)
-        results = extension.search(
-            query)
+        try:
+            results = extension.submit_search(query).result()
+        except CancelledError:
+            # A newer query arrived before this one was run.
+            return DO_NOTHING_ACTION
 
         if results and isinstance(
                 results[0],
@@ -190,7 +519,7 @@ class KeywordQueryEventListener(EventListener):
                     name="Error: 'zoxide' not found",
                     description=
                     "Please install zoxide and make sure it's in your PATH.",
-                    on_enter=HideWindowAction(),
+                    on_enter=HIDE_WINDOW_ACTION,
                 )
             ])
 
@@ -201,52 +530,81 @@ class KeywordQueryEventListener(EventListener):
                     icon="images/icon.png",
                     name="No results matching '%s'" % query,
                     description="Try different search terms",
-                    on_enter=HideWindowAction(),
+                    on_enter=HIDE_WINDOW_ACTION,
                 )
             ])
 
+        # Templates such as '{0[3]}' can fail for some paths only, so a bad
+        # entry is skipped rather than failing the whole result list.
+        format_cmd = extension._format_cmd
+        icon = self._icon_abs
         entries = []
         for path_str in results:
             quoted_path = shlex.quote(path_str)
-
             try:
-                command_string = extension.command_on_select.format(quoted_path)
+                command_string = format_cmd(quoted_path)
             except Exception as fmt_err:
                 logger.error("Error formatting command '%s' with path '%s': %s",
                              extension.command_on_select, quoted_path, fmt_err)
                 continue
 
-            script_action = RunScriptAction(command_string, None)
-
-            update_action = ExtensionCustomAction(path_str,
-                                                  keep_app_open=False)
-
-            actions = [script_action, update_action]
-
             entries.append(
                 ExtensionSmallResultItem(
-                    icon=self.folder_icon,
+                    icon=icon,
                     name=self.get_display_path(path_str),
-                    on_enter=ActionList(actions),
+                    on_enter=ActionList([
+                        RunScriptAction(command_string, None),
+                        ExtensionCustomAction(path_str, keep_app_open=False),
+                    ]),
                 ))
 
         return RenderResultListAction(entries)
 
     def get_display_path(self, path_str):
         """Strip /home/user from path if appropriate."""
+        if path_str == self._home:
+            return "~"
+        if path_str.startswith(self._home_prefix):
+            return "~/" + path_str[len(self._home_prefix):]
+        return path_str
+
+    def _cached_icon_path(self):
+        """Get the folder icon, remembering the result per icon theme on disk.
+
+        Resolving the icon through GIO and GTK is slow, so the resolved path is
+        stored in ICON_CACHE_FILE keyed by the current GTK icon theme name.
+        """
         try:
-            path = Path(path_str)
-            home = Path.home()
-            if path == home:
-                return "~"
-            elif home in path.parents:
-                return "~/" + str(path.relative_to(home))
-            else:
-                return str(path)
+            _, Gtk = _load_gtk()
+            theme = Gtk.Settings.get_default().get_property(
+                "gtk-icon-theme-name")
         except Exception as e:
-            logger.warning("Could not process path '%s' for display: %s",
-                           path_str, e)
-            return path_str
+            logger.warning("Could not determine the GTK icon theme: %s", e)
+            return self.get_folder_icon()
+
+        cache = {}
+        try:
+            with open(ICON_CACHE_FILE, encoding="utf-8") as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            pass
+        if not isinstance(cache, dict):
+            cache = {}
+
+        cached_path = cache.get(theme)
+        if isinstance(cached_path, str) and os.path.exists(cached_path):
+            return cached_path
+
+        folder_icon_path = self.get_folder_icon()
+        if folder_icon_path != FALLBACK_FOLDER_ICON:
+            cache[theme] = folder_icon_path
+            try:
+                os.makedirs(os.path.dirname(ICON_CACHE_FILE), exist_ok=True)
+                with open(ICON_CACHE_FILE, "w", encoding="utf-8") as f:
+                    json.dump(cache, f)
+            except OSError as e:
+                logger.warning("Could not write folder icon cache: %s", e)
+        return folder_icon_path
 
     def get_folder_icon(self):
         """Get a path to a reasonable folder icon.
@@ -254,6 +612,7 @@ class KeywordQueryEventListener(EventListener):
         Fall back to an included one if none is found via GTK.
         """
         try:
+            Gio, Gtk = _load_gtk()
             file = Gio.File.new_for_path(str(
                 Path.home()))
             folder_info = file.query_info(
@@ -262,19 +621,18 @@ class KeywordQueryEventListener(EventListener):
             icon_names = folder_info.get_icon().get_names()
 
             icon_theme = Gtk.IconTheme.get_default()
+            # Prefer the first non-symbolic icon; otherwise keep the first
+            # symbolic one found. Each name is looked up at most once.
             folder_icon_path = None
             for name in icon_names:
+                icon_info = icon_theme.lookup_icon(name, 128, 0)
+                if not icon_info:
+                    continue
                 if "-symbolic" not in name:
-                    icon_info = icon_theme.lookup_icon(name, 128, 0)
-                    if icon_info:
-                        folder_icon_path = icon_info.get_filename()
-                        break
-            if not folder_icon_path:
-                for name in icon_names:
-                    icon_info = icon_theme.lookup_icon(name, 128, 0)
-                    if icon_info:
-                        folder_icon_path = icon_info.get_filename()
-                        break
+                    folder_icon_path = icon_info.get_filename()
+                    break
+                if folder_icon_path is None:
+                    folder_icon_path = icon_info.get_filename()
 
             if folder_icon_path and os.path.exists(folder_icon_path):
                 return folder_icon_path
@@ -288,37 +646,45 @@ class KeywordQueryEventListener(EventListener):
                          e,
                          exc_info=True)
 
-        fallback_icon = "images/folder.png"
-        # logger.info("Falling back to default icon: %s", fallback_icon)
-        return fallback_icon
+        # logger.info("Falling back to default icon: %s", FALLBACK_FOLDER_ICON)
+        return FALLBACK_FOLDER_ICON
 
 
 class ItemEnterEventListener(EventListener):
     """This event listener is called when the user selects an entry."""
 
     def on_event(self, event, extension):
-        """Update the zoxide database for the selected path using 'zoxide add'."""
+        """Update the zoxide database for the selected path using 'zoxide add'.
+
+        The command is started in the background and its result is not awaited.
+        """
         path_str = event.get_data()
         if not path_str or not isinstance(path_str, str):
             logger.warning("ItemEnterEvent received invalid data: %s",
                            path_str)
             return
 
-        cmd = ["zoxide", "add", path_str]
+        if extension.zoxide_bin is None:
+            logger.error(
+                "'zoxide' command not found during add operation. Cannot update database."
+            )
+            return
+
+        cmd = [extension.zoxide_bin, "add", path_str]
         # logger.info("Updating zoxide database for path: '%s' (running %s)",
         #             path_str, " ".join(cmd))
 
+        # Fire and forget: the user has already moved on, so waiting for the
+        # exit status would only stall the UI.
         try:
-            process = subprocess.run(
+            subprocess.Popen(
                 cmd,
-                capture_output=True,
-                text=True,
-                check=False,
-                encoding='utf-8')
-            if process.returncode != 0:
-                logger.error(
-                    "zoxide add failed with code %d for path '%s': %s",
-                    process.returncode, path_str, process.stderr.strip())
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                close_fds=True,
+                start_new_session=True)
+            # Rankings are about to change, so cached query results are stale.
+            extension.clear_query_cache()
         except FileNotFoundError:
             logger.error(
                 "'zoxide' command not found during add operation. Cannot update database."